@@ -0,0 +1,81 @@
+"""Micro-benchmark for the pre-LLM text classification step.
+
+Run from the repository root:
+
+    python bench/bench_intents.py [--extra-rules 500] [--lemmas]
+
+Prints the time per message for IntentMatcher and, for comparison, for
+the keyword loops the webhook used before it.
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from intents import IntentMatcher  # noqa: E402
+from main import INTENT_RULES, NAME_PHRASES, morph  # noqa: E402
+
+SAMPLES = [
+    "привет, как дела?",
+    "меня зовут Олег",
+    "скинь фото пожалуйста",
+    "ты такая милая сегодня",
+    "ну ты и дура конечно",
+    "что делаешь вечером? может созвонимся или запишешь голосовое",
+    "я вчера весь день гулял по городу, устал ужасно, а ты как провела выходные?",
+]
+
+
+def legacy_match(text, rules, name_phrases):
+    lowered = text.lower()
+    result = {"media": None, "mask": None, "name": None}
+    for intent, value, keywords in rules:
+        if result[intent] is None and any(k in lowered for k in keywords):
+            result[intent] = value
+    if any(p in lowered for p in name_phrases):
+        words = text.split()
+        for i, word in enumerate(words):
+            if word.lower() in ["зовут", "меня"] and i + 1 < len(words):
+                result["name"] = words[i + 1]
+                break
+    return result
+
+
+def synthetic_rules(count):
+    letters = "абвгдежзиклмнопрстуфхцчшщэюя"
+    rng = random.Random(0)
+    words = ["".join(rng.choice(letters) for _ in range(rng.randint(4, 9))) for _ in range(count)]
+    return [("mask", "friendly", words[i:i + 5]) for i in range(0, count, 5)]
+
+
+def bench(name, func, messages, repeat):
+    per_call = min(timeit.repeat(lambda: [func(m) for m in messages], number=1, repeat=repeat))
+    print(f"{name:<10} {per_call / len(messages) * 1e6:8.2f} µs/message")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--extra-rules", type=int, default=0, help="synthetic keywords added to the table")
+    parser.add_argument("--lemmas", action="store_true", help="match normal forms with pymorphy2")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.lemmas and not morph:
+        parser.error("--lemmas needs pymorphy2")
+
+    rules = INTENT_RULES + synthetic_rules(args.extra_rules)
+    matcher = IntentMatcher(rules, NAME_PHRASES, morph if args.lemmas else None)
+    rng = random.Random(1)
+    messages = [rng.choice(SAMPLES) for _ in range(args.messages)]
+
+    print(f"{sum(len(r[2]) for r in rules)} keywords, {len(messages)} messages")
+    bench("matcher", matcher.match, messages, args.repeat)
+    bench("legacy", lambda m: legacy_match(m, rules, NAME_PHRASES), messages, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
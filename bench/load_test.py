@@ -0,0 +1,287 @@
+"""Load test for the webhook pipeline against local Telegram and OpenAI stand-ins.
+
+Run from the repository root:
+
+    python bench/load_test.py --rate 50 --count 2000 --chats 200 --llm-latency 1.5
+    python bench/load_test.py --updates recorded_updates.jsonl --rate 20
+
+The bot runs as a uvicorn subprocess pointed at two fake APIs served by this
+script, each with configurable latency. Updates (synthetic, or replayed from
+a JSONL file with one Telegram update per line) are posted to /webhook at
+the target rate. The report has webhook latency, end-to-end latency from
+posting an update to the first sendMessage in its chat, and the bot's
+event-loop lag and queue depth taken from /metrics.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import defaultdict, deque
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SYNTHETIC_TEXTS = [
+    "привет",
+    "как дела?",
+    "меня зовут Оля",
+    "что делаешь?",
+    "скучно сегодня",
+    "расскажи что-нибудь",
+    "ты милая",
+    "ну и ладно",
+]
+
+
+def quantile(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def histogram_quantile(buckets, q):
+    """Upper bound of the bucket holding quantile q, from cumulative (le, count) pairs."""
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return float("nan")
+    for bound, count in buckets:
+        if count >= q * total:
+            return bound
+    return buckets[-1][0]
+
+
+def parse_metrics(text):
+    gauges = {}
+    histograms = defaultdict(list)
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name, value = line.rsplit(" ", 1)
+        if "_bucket{" in name and "le=" in name:
+            base = name.split("_bucket{")[0]
+            bound = name.split('le="')[1].split('"')[0]
+            histograms[base].append((float(bound), float(value)))
+        elif "{" not in name:
+            gauges[name] = float(value)
+    return gauges, histograms
+
+
+class Recorder:
+    def __init__(self):
+        self.outstanding = defaultdict(deque)
+        self.webhook = []
+        self.end_to_end = []
+        self.webhook_errors = 0
+        self.telegram_calls = defaultdict(int)
+
+    def reply_sent(self, chat_id):
+        now = time.perf_counter()
+        pending = self.outstanding[chat_id]
+        while pending:
+            self.end_to_end.append(now - pending.popleft())
+
+
+def fake_telegram(recorder, latency):
+    app = FastAPI()
+
+    @app.post("/bot{token}/{method}")
+    async def call(method: str, request: Request):
+        payload = await request.json()
+        await asyncio.sleep(latency)
+        recorder.telegram_calls[method] += 1
+        if method == "sendMessage":
+            recorder.reply_sent(payload["chat_id"])
+        return {"ok": True, "result": {}}
+
+    return app
+
+
+def fake_openai(latency):
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def completions(request: Request):
+        body = await request.json()
+        text = "ну да. понял тебя. давай дальше."
+        if not body.get("stream"):
+            await asyncio.sleep(latency)
+            return {
+                "id": "fake", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            }
+
+        async def events():
+            words = text.split(" ")
+            for i, word in enumerate(words):
+                await asyncio.sleep(latency / len(words))
+                chunk = {
+                    "id": "fake", "object": "chat.completion.chunk", "model": body["model"],
+                    "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}}],
+                }
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def load_updates(path, count, chats):
+    if path:
+        updates = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    update = json.loads(line)
+                    if isinstance(update.get("message"), dict):
+                        updates.append(update)
+        if not updates:
+            sys.exit(f"{path}: no Telegram updates with a message")
+        return updates[:count] if count else updates
+
+    rng = random.Random(0)
+    return [
+        {
+            "update_id": i,
+            "message": {"message_id": i, "chat": {"id": rng.randrange(chats) + 1}, "text": rng.choice(SYNTHETIC_TEXTS)},
+        }
+        for i in range(count)
+    ]
+
+
+async def serve(app, port):
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    return server, task
+
+
+async def wait_ready(client, url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    sys.exit("bot did not start")
+
+
+async def run(args):
+    recorder = Recorder()
+    tg_server, tg_task = await serve(fake_telegram(recorder, args.telegram_latency), args.port + 1)
+    ai_server, ai_task = await serve(fake_openai(args.llm_latency), args.port + 2)
+
+    env = dict(
+        os.environ,
+        TELEGRAM_TOKEN="test",
+        TELEGRAM_API_BASE=f"http://127.0.0.1:{args.port + 1}",
+        OPENAI_API_KEY="test",
+        OPENAI_API_BASE=f"http://127.0.0.1:{args.port + 2}/v1",
+        LLM_BACKEND="openai",
+        TYPING_DELAY_SCALE=str(args.typing_delay_scale),
+        DEBOUNCE_SECONDS=str(args.debounce),
+        STREAM_REPLIES="1" if args.stream else "0",
+        LOG_LEVEL="WARNING",
+    )
+    bot = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"],
+        cwd=ROOT, env=env,
+    )
+    base = f"http://127.0.0.1:{args.port}"
+    updates = load_updates(args.updates, args.count, args.chats)
+    max_pending = 0
+
+    try:
+        limits = httpx.Limits(max_connections=200)
+        async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+            await wait_ready(client, f"{base}/metrics")
+
+            async def post(update):
+                chat_id = update["message"]["chat"]["id"]
+                start = time.perf_counter()
+                recorder.outstanding[chat_id].append(start)
+                try:
+                    response = await client.post(f"{base}/webhook", json=update)
+                    if response.status_code != 200:
+                        recorder.webhook_errors += 1
+                except httpx.HTTPError:
+                    recorder.webhook_errors += 1
+                recorder.webhook.append(time.perf_counter() - start)
+
+            async def sample_queue():
+                nonlocal max_pending
+                while True:
+                    gauges, _ = parse_metrics((await client.get(f"{base}/metrics")).text)
+                    max_pending = max(max_pending, gauges.get("pending_updates", 0))
+                    await asyncio.sleep(1)
+
+            sampler = asyncio.create_task(sample_queue())
+            started = time.perf_counter()
+            posts = []
+            for i, update in enumerate(updates):
+                delay = started + i / args.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                posts.append(asyncio.create_task(post(update)))
+            await asyncio.gather(*posts)
+            sent_in = time.perf_counter() - started
+
+            deadline = time.monotonic() + args.drain
+            while any(recorder.outstanding.values()) and time.monotonic() < deadline:
+                await asyncio.sleep(0.2)
+            sampler.cancel()
+
+            gauges, histograms = parse_metrics((await client.get(f"{base}/metrics")).text)
+    finally:
+        bot.terminate()
+        bot.wait()
+        tg_server.should_exit = True
+        ai_server.should_exit = True
+        await asyncio.gather(tg_task, ai_task)
+
+    unanswered = sum(len(v) for v in recorder.outstanding.values())
+    lag = histograms.get("event_loop_lag_seconds", [])
+    ms = 1000
+    print(f"updates sent      {len(updates)} in {sent_in:.1f}s ({len(updates) / sent_in:.1f}/s), "
+          f"{recorder.webhook_errors} webhook errors")
+    print(f"webhook           p50 {quantile(recorder.webhook, 0.5) * ms:.1f} ms   "
+          f"p99 {quantile(recorder.webhook, 0.99) * ms:.1f} ms")
+    print(f"end-to-end reply  p50 {quantile(recorder.end_to_end, 0.5):.2f} s    "
+          f"p99 {quantile(recorder.end_to_end, 0.99):.2f} s   ({unanswered} unanswered)")
+    print(f"event-loop lag    p50 <= {histogram_quantile(lag, 0.5) * ms:.0f} ms   "
+          f"p99 <= {histogram_quantile(lag, 0.99) * ms:.0f} ms")
+    print(f"queue depth       max {max_pending:.0f}   chats {gauges.get('chat_states', 0):.0f}")
+    print(f"telegram calls    {dict(recorder.telegram_calls)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", help="JSONL file with one Telegram update per line")
+    parser.add_argument("--count", type=int, default=500, help="updates to send (all of --updates if 0)")
+    parser.add_argument("--chats", type=int, default=100, help="distinct chats for synthetic updates")
+    parser.add_argument("--rate", type=float, default=20, help="updates per second")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="seconds per fake completion")
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="seconds per fake Bot API call")
+    parser.add_argument("--typing-delay-scale", type=float, default=1, help="TYPING_DELAY_SCALE for the bot (1 = real typing delays)")
+    parser.add_argument("--debounce", type=float, default=0, help="DEBOUNCE_SECONDS for the bot")
+    parser.add_argument("--stream", action="store_true", help="run the bot with STREAM_REPLIES=1")
+    parser.add_argument("--drain", type=float, default=30, help="seconds to wait for outstanding replies")
+    parser.add_argument("--port", type=int, default=18080, help="bot port; the fakes use the next two")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+from collections import deque
+
+try:
+    import tiktoken
+    encoding = tiktoken.encoding_for_model("gpt-4")
+except Exception:
+    # missing package, or the encoding file could not be downloaded
+    encoding = None
+
+# chat format adds a few tokens of framing around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def count_tokens(text: str) -> int:
+    if encoding:
+        return len(encoding.encode(text))
+    # without tiktoken assume ~2.5 characters per token, which is on the
+    # safe side for Russian text
+    return len(text) * 2 // 5 + 1
+
+
+def message_tokens(message) -> int:
+    return count_tokens(message.get("content", "")) + MESSAGE_OVERHEAD_TOKENS
+
+
+class HistoryWindow:
+    """Most recent messages of a chat that fit into a token budget.
+
+    Token counts are computed once per message and kept next to it, with a
+    running total, so appending and dropping old messages are O(1). The
+    newest message is always kept, even if it alone exceeds the budget.
+    """
+
+    def __init__(self, budget: int, messages=()):
+        self.budget = budget
+        self.messages = deque()
+        self.tokens = deque()
+        self.total = 0
+        for message in messages:
+            self.append(message)
+
+    def append(self, message):
+        """Add a message and return the ones that fell out of the window."""
+        count = message_tokens(message)
+        self.messages.append(message)
+        self.tokens.append(count)
+        self.total += count
+        evicted = []
+        while self.total > self.budget and len(self.messages) > 1:
+            self.total -= self.tokens.popleft()
+            evicted.append(self.messages.popleft())
+        return evicted
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __getitem__(self, index):
+        return self.messages[index]
@@ -0,0 +1,96 @@
+import re
+from functools import lru_cache
+
+WORD = re.compile(r"[^\W_]+")
+# a captured name may be hyphenated, like "Анна-Мария"
+NAME = re.compile(r"[^\W_]+(?:-[^\W_]+)*")
+
+
+class IntentMatcher:
+    """Finds every triggered rule of a message in a single scan over its words.
+
+    Rules are (intent, value, keywords[, boundary]) tuples. boundary is
+    "prefix" (default: the keyword starts a word, any ending is allowed, so
+    "дура" also hits "дурак") or "word" (the keyword is a whole word).
+
+    Keywords are compiled into dicts keyed by the word or its prefix, each
+    listing the rules that use it, so each word costs a few dict lookups
+    however many rules there are, and can trigger rules of several intents.
+    Name phrases ("меня зовут") capture the word that follows them. When a
+    pymorphy2 analyzer is passed, words are also looked up by their cached
+    normal form, so "тупая" matches "тупым" too.
+    """
+
+    def __init__(self, rules, name_phrases=(), morph=None, cache_size=50000):
+        self.rules = [tuple(rule[:3]) for rule in rules]
+        self.words = {}
+        self.prefixes = {}
+        for index, rule in enumerate(rules):
+            boundary = rule[3] if len(rule) > 3 else "prefix"
+            table = self.prefixes if boundary == "prefix" else self.words
+            for keyword in rule[2]:
+                table.setdefault(keyword.lower(), []).append(index)
+        self.prefix_lengths = sorted({len(k) for k in self.prefixes})
+
+        # first word -> remaining words of each phrase starting with it
+        self.phrases = {}
+        for phrase in name_phrases:
+            first, *rest = phrase.lower().split()
+            self.phrases.setdefault(first, []).append(rest)
+
+        self.morph = morph
+        self.lemmas = {}
+        if morph:
+            self.normal_form = lru_cache(maxsize=cache_size)(self._normal_form)
+            for index, (_, _, keywords) in enumerate(self.rules):
+                for keyword in keywords:
+                    self.lemmas.setdefault(self.normal_form(keyword.lower()), []).append(index)
+
+    def _normal_form(self, word):
+        return self.morph.parse(word)[0].normal_form
+
+    def _lookup(self, word, hits):
+        """Add the indexes of every rule the word triggers to hits."""
+        found = self.words.get(word)
+        if found:
+            hits.update(found)
+        for length in self.prefix_lengths:
+            if length > len(word):
+                break
+            found = self.prefixes.get(word[:length])
+            if found:
+                hits.update(found)
+        if self.lemmas:
+            found = self.lemmas.get(self.normal_form(word))
+            if found:
+                hits.update(found)
+
+    @staticmethod
+    def _name_at(text, lowered, index):
+        """The index-th word, as the user wrote it, hyphenated parts included."""
+        source = text if len(text) == len(lowered) else lowered
+        for i, word in enumerate(WORD.finditer(lowered)):
+            if i == index:
+                return NAME.match(source, word.start()).group()
+
+    def match(self, text):
+        """Return {"media", "mask", "name"}; the earliest rule in the table wins per intent."""
+        lowered = text.lower()
+        words = WORD.findall(lowered)
+        hits = set()
+        name = None
+        for i, word in enumerate(words):
+            self._lookup(word, hits)
+            if name is None and word in self.phrases:
+                for rest in self.phrases[word]:
+                    end = i + 1 + len(rest)
+                    if end < len(words) and words[i + 1:end] == rest:
+                        name = self._name_at(text, lowered, end)
+                        break
+
+        result = {"media": None, "mask": None, "name": name}
+        for index in sorted(hits):
+            intent, value, _ = self.rules[index]
+            if result.get(intent) is None:
+                result[intent] = value
+        return result
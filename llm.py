@@ -0,0 +1,64 @@
+import asyncio
+import os
+
+import openai
+
+import metrics
+
+# "openai" talks to the API; "fake" answers locally for tests and load runs
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0"))
+# requests to the model in flight at once, across replies, pings and summaries
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "32"))
+
+llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+
+
+async def chat_completion(messages, model="gpt-4", max_tokens=None) -> str:
+    async with llm_semaphore:
+        with metrics.llm_seconds.time("completion"):
+            if LLM_BACKEND == "fake":
+                return await fake_completion(messages)
+            kwargs = {"max_tokens": max_tokens} if max_tokens else {}
+            response = await openai.ChatCompletion.acreate(
+                model=model,
+                messages=messages,
+                **kwargs
+            )
+            return response["choices"][0]["message"]["content"]
+
+
+async def stream_completion(messages, model="gpt-4"):
+    """Yield pieces of the reply text as they are generated."""
+    async with llm_semaphore:
+        with metrics.llm_seconds.time("stream"):
+            if LLM_BACKEND == "fake":
+                async for piece in fake_stream(messages):
+                    yield piece
+                return
+            response = await openai.ChatCompletion.acreate(
+                model=model,
+                messages=messages,
+                stream=True
+            )
+            async for chunk in response:
+                piece = chunk["choices"][0]["delta"].get("content")
+                if piece:
+                    yield piece
+
+
+def fake_reply(messages) -> str:
+    last = messages[-1]["content"] if messages else ""
+    return f"ну да. {last[:60]}"
+
+
+async def fake_completion(messages) -> str:
+    await asyncio.sleep(FAKE_LLM_LATENCY)
+    return fake_reply(messages)
+
+
+async def fake_stream(messages):
+    words = fake_reply(messages).split(" ")
+    for i, word in enumerate(words):
+        await asyncio.sleep(FAKE_LLM_LATENCY / len(words))
+        yield word if i == 0 else " " + word
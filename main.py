@@ -1,13 +1,24 @@
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
+from history import count_tokens, message_tokens
+from intents import IntentMatcher
+from llm import chat_completion, stream_completion
+from logs import setup_logging
+from memory import build_memory_message, summarize
+from state_store import create_state_store
 import openai
 import httpx
+import metrics
 import os
 import asyncio
 import random
 import time
 import json
+import logging
+import re
+from collections import OrderedDict, deque
 
 try:
     from pymorphy2 import MorphAnalyzer
@@ -16,20 +27,36 @@ except ModuleNotFoundError:
     morph = None
 
 load_dotenv()
+setup_logging()
+log = logging.getLogger("bot")
 openai.api_key = os.getenv("OPENAI_API_KEY")
 telegram_token = os.getenv("TELEGRAM_TOKEN")
 
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-chat_states = {}
-
 masks = {
     "friendly": {"emoji": "😊", "prompt": "Ты дружелюбный помощник."},
     "flirty": {"emoji": "😉", "prompt": "Ты флиртующий собеседник."},
     "rude": {"emoji": "😒", "prompt": "Ты немного грубый и дерзкий собеседник."},
 }
 
+# Text rules checked on every incoming message: (intent, value, keywords).
+# Keywords match at the start of a word; earlier rules win within an intent.
+INTENT_RULES = [
+    ("media", "📷 Фото загружено.", ["фото"]),
+    ("media", "🎥 Видео прикреплено.", ["видео"]),
+    ("media", "🎤 Голосовое сообщение записано.", ["голос"]),
+    ("media", "📹 Видеосообщение получено.", ["кружочек"]),
+    ("mask", "rude", ["дура", "тупая", "тварь", "идиот"]),
+    ("mask", "flirty", ["милая", "лапочка", "секси", "красотка", "классная"]),
+]
+NAME_PHRASES = ["меня зовут", "зови меня"]
+# also match other word forms through pymorphy2 normal forms
+INTENT_LEMMAS = os.getenv("INTENT_LEMMAS", "0") == "1"
+
+intent_matcher = IntentMatcher(INTENT_RULES, NAME_PHRASES, morph if INTENT_LEMMAS else None)
+
 DEFAULT_STYLE_EXAMPLE = """[
     {"role": "user", "content": "ну че ты там"},
     {"role": "assistant", "content": "да ниче лол"},
@@ -41,8 +68,71 @@ DEFAULT_STYLE_EXAMPLE = """[
 
 PING_MIN_DELAY = 60
 PING_MAX_DELAY = 120
-
-MAX_HISTORY_CHARS = 20000
+PING_CONCURRENCY = int(os.getenv("PING_CONCURRENCY", "10"))
+# pause after a failed pass (e.g. the database is locked) before trying again
+PING_RETRY_DELAY = float(os.getenv("PING_RETRY_DELAY", "5"))
+
+# Ping deadlines are kept by the state store; these track the pings in flight.
+ping_tasks = {}
+ping_wakeup = asyncio.Event()
+ping_semaphore = asyncio.Semaphore(PING_CONCURRENCY)
+
+# History is budgeted in tokens: whatever the model context leaves after the
+# system prompt and the room reserved for the reply (and the ping nudge).
+MODEL_CONTEXT_TOKENS = int(os.getenv("MODEL_CONTEXT_TOKENS", "8192"))
+REPLY_TOKEN_RESERVE = int(os.getenv("REPLY_TOKEN_RESERVE", "1024"))
+
+# With summaries on, messages leaving a smaller history window are folded
+# into a per-chat summary in the background, so the prompt stays bounded by
+# system prompt + summary + window however long the chat runs.
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "0") == "1"
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-3.5-turbo")
+SUMMARY_WINDOW_TOKENS = int(os.getenv("SUMMARY_WINDOW_TOKENS", "2000"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "400"))
+SUMMARY_MIN_PENDING_TOKENS = int(os.getenv("SUMMARY_MIN_PENDING_TOKENS", "500"))
+SUMMARY_MAX_PENDING_TOKENS = int(os.getenv("SUMMARY_MAX_PENDING_TOKENS", "4000"))
+
+summary_tasks = {}
+
+# Webhook updates are queued per chat; each chat's lane runs its turns in
+# order as a task of its own. Only model calls are bounded (LLM_CONCURRENCY
+# in llm.py), so turns sleeping through the simulated typing cost nothing.
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", "2000"))
+MAX_PENDING_PER_CHAT = int(os.getenv("MAX_PENDING_PER_CHAT", "20"))
+
+# Streaming mode sends the reply sentence by sentence while it is generated.
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "0") == "1"
+STREAM_MIN_CHUNK_CHARS = int(os.getenv("STREAM_MIN_CHUNK_CHARS", "40"))
+TYPING_REFRESH_INTERVAL = 4.5
+# scales the simulated typing delay; load tests set it near zero
+TYPING_DELAY_SCALE = float(os.getenv("TYPING_DELAY_SCALE", "1"))
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+# One pooled client is shared by all Telegram calls. Telegram allows about
+# 30 messages/s overall and about 1 message/s in a single chat.
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+TELEGRAM_MAX_CONNECTIONS = int(os.getenv("TELEGRAM_MAX_CONNECTIONS", "50"))
+
+# Errors raised before the request reached Telegram. After a read timeout,
+# a dropped connection or a 5xx the message may already be delivered, so
+# only these are retried, except for methods that are harmless to repeat.
+TELEGRAM_RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+TELEGRAM_IDEMPOTENT_METHODS = {"sendChatAction"}
+
+telegram_client = None
+
+# Messages a user sends within DEBOUNCE_SECONDS of each other are answered
+# as one turn. Recently seen update_ids are kept to drop re-deliveries.
+DEBOUNCE_SECONDS = float(os.getenv("DEBOUNCE_SECONDS", "1.5"))
+SEEN_UPDATES_SIZE = int(os.getenv("SEEN_UPDATES_SIZE", "10000"))
+
+chat_lanes = {}
+pending_updates = 0
+seen_updates = OrderedDict()
+background_tasks = []
 
 SYSTEM_PROMPT = (
     "Ты ведёшь переписку в мессенджере. Никогда не говори, что ты бот или ассистент. "
@@ -54,6 +144,18 @@ SYSTEM_PROMPT = (
     "Не навязывайся, но будь рядом, когда нужно."
 )
 
+HISTORY_TOKEN_BUDGET = MODEL_CONTEXT_TOKENS - count_tokens(SYSTEM_PROMPT) - REPLY_TOKEN_RESERVE
+if SUMMARY_ENABLED:
+    # leave room for the memory message (summary plus the name line)
+    HISTORY_TOKEN_BUDGET = min(SUMMARY_WINDOW_TOKENS, HISTORY_TOKEN_BUDGET - SUMMARY_MAX_TOKENS - 100)
+
+chat_states = create_state_store(HISTORY_TOKEN_BUDGET)
+
+metrics.Gauge("chat_states", "Chats in the state store.", lambda: len(chat_states))
+metrics.Gauge("pending_updates", "Updates queued and not yet taken into a turn.", lambda: pending_updates)
+metrics.Gauge("chat_lanes", "Chats with queued or in-progress updates.", lambda: len(chat_lanes))
+metrics.Gauge("pings_in_flight", "Pings being generated or sent.", lambda: len(ping_tasks))
+
 def inflect_name(name):
     if not morph:
         return {"nomn": name, "accs": name, "ablt": name}
@@ -69,173 +171,514 @@ def insert_name(chat_id, template: str) -> str:
     if not user or not user.get("inflections"):
         return template
     f = user["inflections"]
-    return template.format(
-        name=f.get("nomn", ""),
-        acc=f.get("accs", ""),
-        ins=f.get("ablt", "")
-    )
+    try:
+        return template.format(
+            name=f.get("nomn", ""),
+            acc=f.get("accs", ""),
+            ins=f.get("ablt", "")
+        )
+    except (KeyError, IndexError, ValueError):
+        # braces in the model's text that aren't name placeholders
+        return template
 
-def trim_history(chat_id, max_chars=MAX_HISTORY_CHARS):
-    history = chat_states[chat_id]["history"]
-    total = 0
-    trimmed = []
-    for msg in reversed(history):
-        total += len(msg.get("content", ""))
-        trimmed.append(msg)
-        if total > max_chars:
-            break
-    trimmed = list(reversed(trimmed[:-1])) if total > max_chars else list(reversed(trimmed))
-    chat_states[chat_id]["history"] = trimmed
+def build_messages(state):
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    memory = build_memory_message(state)
+    if memory:
+        messages.append(memory)
+    messages += state["history"]
+    metrics.history_messages.observe(len(state["history"]))
+    metrics.history_tokens.observe(state["history"].total)
+    return messages
+
+def remember(chat_id, state, message):
+    evicted = chat_states.append_history(chat_id, state, message)
+    if not evicted or not SUMMARY_ENABLED:
+        return
+    pending = state.setdefault("summary_pending", [])
+    # numbered so update_summary can tell which ones it has folded in
+    for m in evicted:
+        state["summary_seq"] += 1
+        pending.append({"seq": state["summary_seq"], **m})
+    pending_tokens = sum(message_tokens(m) for m in pending)
+    # if summarising keeps failing, forget the oldest messages instead of growing
+    while pending_tokens > SUMMARY_MAX_PENDING_TOKENS and len(pending) > 1:
+        pending_tokens -= message_tokens(pending.pop(0))
+    chat_states.save(chat_id, state)
+    if pending_tokens >= SUMMARY_MIN_PENDING_TOKENS and chat_id not in summary_tasks:
+        summary_tasks[chat_id] = asyncio.create_task(update_summary(chat_id, state))
+
+async def update_summary(chat_id, state):
+    try:
+        pending = list(state["summary_pending"])
+        summary = await summarize(state.get("summary"), pending, SUMMARY_MODEL, SUMMARY_MAX_TOKENS)
+        # remember() may have added messages and dropped old ones meanwhile;
+        # everything numbered up to our last one is now in the summary
+        last_seq = pending[-1]["seq"]
+        state["summary_pending"] = [m for m in state["summary_pending"] if m["seq"] > last_seq]
+        state["summary"] = summary
+        chat_states.save(chat_id, state)
+    except Exception:
+        log.exception("ошибка сводки", extra={"chat_id": chat_id})
+    finally:
+        summary_tasks.pop(chat_id, None)
+
+class ChatLane:
+    def __init__(self):
+        self.updates = deque()
+        self.last_at = 0
+        # the turn being generated, and whether its reply has started going out
+        self.task = None
+        self.delivering = False
+        # run_turn driving the lane, kept so shutdown can cancel it
+        self.runner = None
+        # updates taken by the running turn and not yet in the chat history;
+        # if the turn is cancelled before saving them, they go back in the lane
+        self.taken = []
+
+def schedule_lane(chat_id, lane):
+    # start the turn once the user has been quiet for DEBOUNCE_SECONDS
+    delay = lane.last_at + DEBOUNCE_SECONDS - time.monotonic()
+    if delay > 0:
+        asyncio.get_running_loop().call_later(delay, schedule_lane, chat_id, lane)
+    else:
+        lane.runner = asyncio.create_task(run_turn(chat_id, lane))
+
+def mark_delivering(chat_id):
+    lane = chat_lanes.get(chat_id)
+    if lane:
+        lane.delivering = True
+
+def mark_remembered(chat_id):
+    lane = chat_lanes.get(chat_id)
+    if lane:
+        lane.taken = []
+
+def is_duplicate_update(update_id) -> bool:
+    if update_id is None:
+        return False
+    if update_id in seen_updates:
+        seen_updates.move_to_end(update_id)
+        return True
+    seen_updates[update_id] = None
+    if len(seen_updates) > SEEN_UPDATES_SIZE:
+        seen_updates.popitem(last=False)
+    return False
+
+def enqueue_update(chat_id, payload) -> bool:
+    global pending_updates
+    if pending_updates >= MAX_PENDING_UPDATES:
+        return False
+    lane = chat_lanes.get(chat_id)
+    if lane is None:
+        lane = chat_lanes[chat_id] = ChatLane()
+    elif len(lane.updates) >= MAX_PENDING_PER_CHAT:
+        return False
+    lane.updates.append(payload)
+    lane.last_at = time.monotonic()
+    pending_updates += 1
+    cancel_ping(chat_id)
+
+    if len(lane.updates) == 1 and lane.task is None:
+        schedule_lane(chat_id, lane)
+    elif lane.task and not lane.delivering:
+        # the user kept typing: drop the reply in progress, run_turn
+        # restarts it with the new messages once the user is quiet again
+        lane.task.cancel()
+    return True
+
+async def run_turn(chat_id, lane):
+    global pending_updates
+    lane.taken = list(lane.updates)
+    texts = [p["message"].get("text", "") for p in lane.taken]
+    pending_updates -= len(lane.taken)
+    lane.updates.clear()
+    lane.delivering = False
+    lane.task = asyncio.create_task(handle_update(chat_id, "\n".join(texts)))
+    try:
+        with metrics.turn_seconds.time():
+            await asyncio.wait([lane.task])
+        if lane.task.cancelled():
+            log.info("пользователь дописал, ответ перезапускается", extra={"chat_id": chat_id})
+            # answer the messages the turn hadn't saved together with the new ones
+            lane.updates.extendleft(reversed(lane.taken))
+            pending_updates += len(lane.taken)
+        elif lane.task.exception():
+            log.error("ошибка обработки", exc_info=lane.task.exception(), extra={"chat_id": chat_id})
+    finally:
+        lane.task.cancel()
+        lane.task = None
+        lane.runner = None
+        lane.taken = []
+        # the lane stays registered while its turn runs, so new updates for
+        # this chat wait for it instead of starting a second turn
+        if lane.updates:
+            schedule_lane(chat_id, lane)
+        else:
+            del chat_lanes[chat_id]
+
+def accept_update(payload):
+    message = payload.get("message")
+    if not isinstance(message, dict) or "chat" not in message:
+        return {"ok": True}
+
+    update_id = payload.get("update_id")
+    if is_duplicate_update(update_id):
+        log.info("повтор апдейта, пропускаем", extra={"update_id": update_id})
+        return {"ok": True}
+
+    chat_id = message["chat"]["id"]
+    if not enqueue_update(chat_id, payload):
+        # non-2xx makes Telegram keep the update and re-deliver it later,
+        # so it must not count as seen
+        seen_updates.pop(update_id, None)
+        log.warning("очередь переполнена", extra={"chat_id": chat_id, "pending": pending_updates})
+        return JSONResponse(status_code=429, content={"ok": False})
+
+    log.info("апдейт принят", extra={"chat_id": chat_id, "update_id": update_id})
+    return {"ok": True}
 
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
+    start = time.perf_counter()
     payload = await request.json()
-    print("📩 INCOMING from Telegram:", payload)
+    log.debug("входящий апдейт", extra={"payload": payload})
+    response = accept_update(payload)
+    metrics.webhook_seconds.observe(time.perf_counter() - start)
+    return response
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render())
+
+async def handle_update(chat_id, text):
+    intents = intent_matcher.match(text)
+
+    fake_media = intents["media"]
+    if fake_media:
+        lead_in = random.choice(["лови", "держи", "смотри", "вот", "на"])
+        mark_delivering(chat_id)
+        await send_telegram_message(chat_id, f"{lead_in}\n{fake_media}")
+        await asyncio.sleep(10)
+        follow_up = random.choice(["ещё хочешь?", "нравится?", "а тебе как?"])
+        await send_telegram_message(chat_id, follow_up)
+        return
 
-    try:
-        chat_id = payload["message"]["chat"]["id"]
-        text = payload["message"].get("text", "")
-
-        media_keywords = {
-            "фото": "📷 Фото загружено.",
-            "видео": "🎥 Видео прикреплено.",
-            "голос": "🎤 Голосовое сообщение записано.",
-            "кружочек": "📹 Видеосообщение получено."
-        }
-
-        for keyword, fake_media in media_keywords.items():
-            if keyword in text.lower():
-                lead_in = random.choice(["лови", "держи", "смотри", "вот", "на"])
-                await send_telegram_message(chat_id, f"{lead_in}\n{fake_media}")
-                await asyncio.sleep(10)
-                follow_up = random.choice(["ещё хочешь?", "нравится?", "а тебе как?"])
-                await send_telegram_message(chat_id, follow_up)
-                return {"ok": True}
+    now = time.time()
+    state = await chat_states.load(chat_id, create=True)
+    state["last_user_message"] = now
+    state["ping_sent_at"] = 0
+    cancel_ping(chat_id)
 
-        now = time.time()
-        chat_states.setdefault(chat_id, {
-            "history": [],
-            "last_bot_reply": 0,
-            "last_user_message": 0,
-            "mask": "friendly",
-            "name": None,
-            "inflections": None,
-            "style_learned": None,
-            "ping_sent_at": 0
-        })
+    name = intents["name"]
+    if name:
+        state["name"] = name
+        state["inflections"] = inflect_name(name)
 
-        chat_states[chat_id]["last_user_message"] = now
-        chat_states[chat_id]["ping_sent_at"] = 0
-
-        lowered = text.lower()
-
-        if any(p in lowered for p in ["меня зовут", "зови меня"]):
-            words = text.split()
-            name = None
-            for i, word in enumerate(words):
-                if word.lower() in ["зовут", "меня"]:
-                    if i + 1 < len(words):
-                        name = words[i + 1]
-                        break
-            if name:
-                chat_states[chat_id]["name"] = name
-                chat_states[chat_id]["inflections"] = inflect_name(name)
-
-        history = chat_states[chat_id]["history"]
-        history.append({"role": "user", "content": text})
-        trim_history(chat_id)
-
-        if any(word in lowered for word in ["дура", "тупая", "тварь", "идиот"]):
-            chat_states[chat_id]["mask"] = "rude"
-        elif any(word in lowered for word in ["милая", "лапочка", "секси", "красотка", "классная"]):
-            chat_states[chat_id]["mask"] = "flirty"
-        else:
-            chat_states[chat_id]["mask"] = "friendly"
+    remember(chat_id, state, {"role": "user", "content": text})
+    mark_remembered(chat_id)
 
-        mask = chat_states[chat_id]["mask"]
-        style = chat_states[chat_id].get("style_learned") or DEFAULT_STYLE_EXAMPLE
+    state["mask"] = intents["mask"] or "friendly"
+    chat_states.save(chat_id, state)
 
-        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-        messages += chat_states[chat_id]["history"]
+    mask = state["mask"]
+    style = state.get("style_learned") or DEFAULT_STYLE_EXAMPLE
 
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=messages
-        )
-        reply = response["choices"][0]["message"]["content"]
-        await send_typing_action(chat_id)
-        char_count = len(reply)
-        typing_speed = random.uniform(7, 10)
-        delay = min(60, max(5, char_count / typing_speed))
-        print(f"⌛ Задержка перед ответом: {delay:.1f} сек ({char_count} символов)")
-        await asyncio.sleep(delay)
-        reply = insert_name(chat_id, reply)
-        history.append({"role": "assistant", "content": reply})
-        full_reply = f"{reply}\n\nМаска: {mask}"
-        await send_telegram_message(chat_id, full_reply)
-        chat_states[chat_id]["last_bot_reply"] = time.time()
-        chat_states[chat_id]["ping_sent_at"] = 0
+    messages = build_messages(state)
 
-    except Exception as e:
-        print("❌ Ошибка:", e)
+    sent = []
+    try:
+        if STREAM_REPLIES:
+            await stream_reply(chat_id, messages, mask, sent)
+        else:
+            reply = await chat_completion(messages)
+            await send_typing_action(chat_id)
+            char_count = len(reply)
+            delay = typing_delay(char_count)
+            log.debug("задержка перед ответом", extra={"chat_id": chat_id, "delay": round(delay, 1), "chars": char_count})
+            await asyncio.sleep(delay)
+            reply = insert_name(chat_id, reply)
+            full_reply = f"{reply}\n\nМаска: {mask}"
+            mark_delivering(chat_id)
+            await send_telegram_message(chat_id, full_reply)
+            sent.append(reply)
+    finally:
+        # whatever reached the user is part of the chat, even if the rest failed
+        if sent:
+            remember(chat_id, state, {"role": "assistant", "content": "\n".join(sent)})
+            state["last_bot_reply"] = time.time()
+            state["ping_sent_at"] = 0
+            chat_states.save(chat_id, state)
+            schedule_ping(chat_id, state["last_bot_reply"] + PING_MIN_DELAY)
+
+def typing_delay(char_count):
+    typing_speed = random.uniform(7, 10)
+    return min(60, max(5, char_count / typing_speed)) * TYPING_DELAY_SCALE
+
+def split_ready_chunks(buffer):
+    """Cut finished sentences or lines off streamed text; returns (chunks, rest)."""
+    chunks = []
+    start = 0
+    for match in SENTENCE_END.finditer(buffer):
+        chunk = buffer[start:match.start()].strip()
+        # short sentences are merged with the next one, line breaks always split
+        if len(chunk) >= STREAM_MIN_CHUNK_CHARS or "\n" in match.group():
+            if chunk:
+                chunks.append(chunk)
+            start = match.end()
+    return chunks, buffer[start:]
+
+async def keep_typing(chat_id):
+    while True:
+        await send_typing_action(chat_id)
+        await asyncio.sleep(TYPING_REFRESH_INTERVAL)
+
+async def stream_reply(chat_id, messages, mask, sent):
+    """Send the reply chunk by chunk as it is generated, adding each sent chunk to sent."""
+    chunks = asyncio.Queue()
+
+    async def produce():
+        buffer = ""
+        try:
+            async for piece in stream_completion(messages):
+                buffer += piece
+                ready, buffer = split_ready_chunks(buffer)
+                for chunk in ready:
+                    chunks.put_nowait(chunk)
+            if buffer.strip():
+                chunks.put_nowait(buffer.strip())
+        finally:
+            chunks.put_nowait(None)
+
+    typing = asyncio.create_task(keep_typing(chat_id))
+    producer = asyncio.create_task(produce())
+    try:
+        # the simulated typing of a chunk starts once the previous one is sent,
+        # so time spent generating it counts towards its delay
+        typing_started = time.monotonic()
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                break
+            delay = typing_delay(len(chunk)) - (time.monotonic() - typing_started)
+            log.debug("задержка перед частью ответа", extra={"chat_id": chat_id, "delay": round(max(0, delay), 1), "chars": len(chunk)})
+            if delay > 0:
+                await asyncio.sleep(delay)
+            chunk = insert_name(chat_id, chunk)
+            mark_delivering(chat_id)
+            await send_telegram_message(chat_id, f"{chunk}\n\nМаска: {mask}")
+            sent.append(chunk)
+            typing_started = time.monotonic()
+        await producer
+    finally:
+        typing.cancel()
+        producer.cancel()
+
+def new_telegram_client():
+    limits = httpx.Limits(
+        max_connections=TELEGRAM_MAX_CONNECTIONS,
+        max_keepalive_connections=TELEGRAM_MAX_CONNECTIONS,
+    )
+    return httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(15.0, connect=5.0))
 
-    return {"ok": True}
+async def monitor_event_loop_lag(interval=0.5):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        metrics.event_loop_lag_seconds.observe(max(0, time.perf_counter() - start - interval))
 
 @app.on_event("startup")
 async def startup_event():
-    asyncio.create_task(ping_loop())
+    global telegram_client
+    telegram_client = new_telegram_client()
+    await chat_states.start()
+    background_tasks.append(asyncio.create_task(ping_loop()))
+    background_tasks.append(asyncio.create_task(monitor_event_loop_lag()))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    global telegram_client
+    turns = [lane.runner for lane in chat_lanes.values() if lane.runner]
+    for task in background_tasks + turns + list(ping_tasks.values()) + list(summary_tasks.values()):
+        task.cancel()
+    await asyncio.gather(*background_tasks, *turns, return_exceptions=True)
+    background_tasks.clear()
+    if telegram_client is not None:
+        await telegram_client.aclose()
+        telegram_client = None
+    await chat_states.close()
+
+def schedule_ping(chat_id, when):
+    if chat_states.schedule_ping(chat_id, when):
+        ping_wakeup.set()
+
+def cancel_ping(chat_id):
+    chat_states.cancel_ping(chat_id)
+    task = ping_tasks.pop(chat_id, None)
+    if task:
+        task.cancel()
 
 async def ping_loop():
     while True:
-        await asyncio.sleep(10)
-
-        now = time.time()
-        for chat_id, state in chat_states.items():
-            history = state["history"]
-            if not history:
-                continue
-            if history[-1]["role"] != "assistant":
-                continue
-
-            last_reply = state.get("last_bot_reply", 0)
-            ping_sent_at = state.get("ping_sent_at", 0)
-
-            since_reply = now - last_reply
-            since_ping = now - ping_sent_at if ping_sent_at else None
-
-            if since_reply >= PING_MIN_DELAY and (ping_sent_at == 0 or since_ping >= PING_MIN_DELAY):
-                print(f"[ping triggered] chat_id={chat_id}, silence for {since_reply:.1f}s")
+        tick_started = time.perf_counter()
+        failed = False
+        try:
+            while True:
+                await ping_semaphore.acquire()
                 try:
-                    style = state.get("style_learned") or DEFAULT_STYLE_EXAMPLE
-                    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-                    messages += state["history"]
-                    name = state.get("inflections", {}).get("nomn", "друг")
-                    messages.append({
-                        "role": "user",
-                        "content": f"Ты давно молчишь с {name}. Напиши что-нибудь!"
-                    })
-                    response = openai.ChatCompletion.create(
-                        model="gpt-4",
-                        messages=messages
-                    )
-                    reply = response["choices"][0]["message"]["content"]
-                    reply = insert_name(chat_id, reply)
-                    full_reply = f"{reply}\n\n{masks[state['mask']]['emoji']} Маска: {state['mask'].capitalize()}"
-                    await send_telegram_message(chat_id, full_reply)
-                    state["last_bot_reply"] = now
-                    state["ping_sent_at"] = now
-                    state["history"].append({"role": "assistant", "content": reply})
-                except Exception as e:
-                    print(f"❌ Ошибка при пинге {chat_id}: {e}")
+                    due = await chat_states.pop_due_pings(time.time(), 1)
+                except BaseException:
+                    ping_semaphore.release()
+                    raise
+                if not due:
+                    ping_semaphore.release()
+                    break
+                chat_id = due[0]
+                task = ping_tasks[chat_id] = asyncio.create_task(send_ping(chat_id))
+                # a done callback also runs when the task is cancelled before it starts
+                task.add_done_callback(lambda _: ping_semaphore.release())
+        except Exception:
+            # the store keeps the deadlines it could not hand out
+            failed = True
+            log.exception("ошибка планировщика пингов")
+        metrics.ping_tick_seconds.observe(time.perf_counter() - tick_started)
+
+        next_ping_at = chat_states.next_ping_at()
+        timeout = max(0, next_ping_at - time.time()) if next_ping_at is not None else None
+        if failed:
+            timeout = PING_RETRY_DELAY
+        ping_wakeup.clear()
+        try:
+            await asyncio.wait_for(ping_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+async def send_ping(chat_id):
+    try:
+        state = await chat_states.load(chat_id)
+        if not state:
+            return
+        history = state["history"]
+        if not history or history[-1]["role"] != "assistant":
+            return
+
+        since_reply = time.time() - state.get("last_bot_reply", 0)
+        log.info("пинг", extra={"chat_id": chat_id, "silence": round(since_reply, 1)})
+        style = state.get("style_learned") or DEFAULT_STYLE_EXAMPLE
+        messages = build_messages(state)
+        name = (state.get("inflections") or {}).get("nomn", "друг")
+        messages.append({
+            "role": "user",
+            "content": f"Ты давно молчишь с {name}. Напиши что-нибудь!"
+        })
+        reply = await chat_completion(messages)
+        # from here on the ping is delivered even if the user writes meanwhile
+        if ping_tasks.get(chat_id) is asyncio.current_task():
+            del ping_tasks[chat_id]
+        reply = insert_name(chat_id, reply)
+        full_reply = f"{reply}\n\n{masks[state['mask']]['emoji']} Маска: {state['mask'].capitalize()}"
+        await send_telegram_message(chat_id, full_reply)
+        now = time.time()
+        state["last_bot_reply"] = now
+        state["ping_sent_at"] = now
+        remember(chat_id, state, {"role": "assistant", "content": reply})
+        chat_states.save(chat_id, state)
+        schedule_ping(chat_id, now + PING_MIN_DELAY)
+    except asyncio.CancelledError:
+        log.info("пинг отменён", extra={"chat_id": chat_id})
+    except Exception:
+        log.exception("ошибка при пинге", extra={"chat_id": chat_id})
+    finally:
+        if ping_tasks.get(chat_id) is asyncio.current_task():
+            del ping_tasks[chat_id]
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        # the lock keeps waiters in FIFO order while one of them sleeps
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+global_send_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+chat_send_slots = {}
+
+async def wait_chat_slot(chat_id):
+    now = time.monotonic()
+    if len(chat_send_slots) > 10000:
+        for key in [k for k, slot in chat_send_slots.items() if slot < now]:
+            del chat_send_slots[key]
+    slot = max(now, chat_send_slots.get(chat_id, 0))
+    chat_send_slots[chat_id] = slot + 1 / TELEGRAM_CHAT_RATE
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+async def telegram_request(method: str, payload: dict):
+    if telegram_client is None:
+        # not started yet or already shut down
+        log.error("telegram клиент закрыт", extra={"method": method})
+        return None
+    with metrics.telegram_seconds.time(method):
+        return await telegram_call(method, payload)
+
+async def telegram_call(method: str, payload: dict):
+    url = f"{TELEGRAM_API_BASE}/bot{telegram_token}/{method}"
+    backoff = 1.0
+    for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+        last_try = attempt == TELEGRAM_MAX_RETRIES
+        await global_send_bucket.acquire()
+        try:
+            response = await telegram_client.post(url, json=payload)
+        except httpx.TransportError as e:
+            retryable = isinstance(e, TELEGRAM_RETRY_ERRORS) or method in TELEGRAM_IDEMPOTENT_METHODS
+            if last_try or not retryable:
+                log.error("telegram не отправлен", extra={"method": method, "error": repr(e)})
+                return None
+            await asyncio.sleep(backoff)
+            backoff *= 2
+            continue
+
+        if response.status_code == 429:
+            try:
+                retry_after = response.json().get("parameters", {}).get("retry_after", backoff)
+            except ValueError:
+                retry_after = backoff
+            log.warning("telegram 429", extra={"method": method, "retry_after": retry_after})
+            if last_try:
+                return None
+            await asyncio.sleep(retry_after)
+            backoff *= 2
+            continue
+        if response.status_code >= 500:
+            if last_try or method not in TELEGRAM_IDEMPOTENT_METHODS:
+                log.error("ошибка telegram", extra={"method": method, "status": response.status_code})
+                return None
+            await asyncio.sleep(backoff)
+            backoff *= 2
+            continue
+        if response.status_code >= 400:
+            log.error("ошибка telegram", extra={"method": method, "status": response.status_code, "body": response.text})
+            return None
+        return response.json()
+    return None
 
 async def send_typing_action(chat_id: int):
-    url = f"https://api.telegram.org/bot{telegram_token}/sendChatAction"
     payload = {"chat_id": chat_id, "action": "typing"}
-    async with httpx.AsyncClient() as client:
-        await client.post(url, json=payload)
+    await telegram_request("sendChatAction", payload)
 
 async def send_telegram_message(chat_id: int, text: str):
-    url = f"https://api.telegram.org/bot{telegram_token}/sendMessage"
+    await wait_chat_slot(chat_id)
     payload = {"chat_id": chat_id, "text": text}
-    async with httpx.AsyncClient() as client:
-        await client.post(url, json=payload)
\ No newline at end of file
+    await telegram_request("sendMessage", payload)
@@ -0,0 +1,32 @@
+from llm import chat_completion
+
+SUMMARY_PROMPT = (
+    "Ты ведёшь краткую память о переписке. Тебе дают прежнюю сводку и новые сообщения. "
+    "Перепиши сводку так, чтобы в ней были факты о собеседнике, важные события, "
+    "договорённости и общий тон общения. Пиши сжато, в третьем лице, без цитат."
+)
+
+
+def build_memory_message(state):
+    """System message with what the bot remembers beyond the history window."""
+    parts = []
+    if state.get("summary"):
+        parts.append(f"Что ты помнишь о прошлой переписке: {state['summary']}")
+    inflections = state.get("inflections")
+    if inflections:
+        parts.append(
+            f"Собеседника зовут {inflections.get('nomn', '')} "
+            f"(вин. падеж: {inflections.get('accs', '')}, твор. падеж: {inflections.get('ablt', '')})."
+        )
+    if not parts:
+        return None
+    return {"role": "system", "content": "\n".join(parts)}
+
+
+async def summarize(previous, messages, model, max_tokens) -> str:
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    prompt = [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": f"Прежняя сводка:\n{previous or 'нет'}\n\nНовые сообщения:\n{transcript}"},
+    ]
+    return await chat_completion(prompt, model=model, max_tokens=max_tokens)
@@ -0,0 +1,91 @@
+import time
+from contextlib import contextmanager
+
+# seconds, from a fast Telegram call up to a slow GPT-4 completion
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+registry = []
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labels = labels
+        # label values -> [per-bucket counts, sum, count]
+        self.series = {}
+        registry.append(self)
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labels, label_values, [("le", bound)])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, label_values, [("le", "+Inf")])
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Gauge:
+    """Gauge whose value is read from a callback at scrape time."""
+
+    def __init__(self, name, help, func):
+        self.name = name
+        self.help = help
+        self.func = func
+        registry.append(self)
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.func()}"]
+
+
+def render():
+    """All registered metrics in the Prometheus text format."""
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+llm_seconds = Histogram("llm_request_seconds", "Duration of LLM completions.", labels=("kind",))
+telegram_seconds = Histogram("telegram_request_seconds", "Duration of Telegram Bot API calls, retries included.", labels=("method",))
+webhook_seconds = Histogram("webhook_seconds", "Time to acknowledge a webhook update.")
+turn_seconds = Histogram("turn_seconds", "Time from the start of a chat turn until its reply is sent.")
+ping_tick_seconds = Histogram("ping_tick_seconds", "Time ping_loop spends dispatching due pings per wake-up.")
+event_loop_lag_seconds = Histogram("event_loop_lag_seconds", "How late a periodic event loop timer fires.")
+history_messages = Histogram("history_messages", "Messages in the history window sent with a prompt.", SIZE_BUCKETS)
+history_tokens = Histogram("history_tokens", "Tokens in the history window sent with a prompt.", SIZE_BUCKETS)
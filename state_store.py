@@ -0,0 +1,572 @@
+import abc
+import asyncio
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from history import HistoryWindow
+
+log = logging.getLogger("bot.state")
+
+
+class ChatState(dict):
+    """A chat's state dict.
+
+    A subclass so stores can hold weak references to it and note the stored
+    version, and stored fields, it was last read or written at.
+    """
+
+    version = None
+    base = None
+
+
+def new_chat_state(history_budget):
+    return ChatState({
+        "history": HistoryWindow(history_budget),
+        "last_bot_reply": 0,
+        "last_user_message": 0,
+        "mask": "friendly",
+        "name": None,
+        "inflections": None,
+        "style_learned": None,
+        "ping_sent_at": 0,
+        "summary": None,
+        "summary_pending": [],
+        "summary_seq": 0
+    })
+
+
+def stored_fields(state):
+    """JSON of everything in a state except its history, which is stored by row."""
+    return json.dumps({k: v for k, v in state.items() if k != "history"}, ensure_ascii=False)
+
+
+class PingSchedule:
+    """Ping deadlines by chat, with the earliest one at hand."""
+
+    def __init__(self):
+        # min-heap of (deadline, chat_id); entries that don't match
+        # deadlines are stale and skipped lazily
+        self.heap = []
+        self.deadlines = {}
+
+    def schedule(self, chat_id, when) -> bool:
+        self.deadlines[chat_id] = when
+        heapq.heappush(self.heap, (when, chat_id))
+        if len(self.heap) > 2 * len(self.deadlines) + 1000:
+            self.heap = [(deadline, cid) for cid, deadline in self.deadlines.items()]
+            heapq.heapify(self.heap)
+        return self.heap[0] == (when, chat_id)
+
+    def cancel(self, chat_id):
+        self.deadlines.pop(chat_id, None)
+
+    def pop_due(self, now, limit):
+        """Remove and return up to limit (chat_id, deadline) pairs that are due."""
+        due = []
+        while self.heap and len(due) < limit and self.heap[0][0] <= now:
+            when, chat_id = heapq.heappop(self.heap)
+            if self.deadlines.get(chat_id) != when:
+                continue
+            del self.deadlines[chat_id]
+            due.append((chat_id, when))
+        return due
+
+    def next_at(self):
+        while self.heap:
+            when, chat_id = self.heap[0]
+            if self.deadlines.get(chat_id) == when:
+                return when
+            heapq.heappop(self.heap)
+        return None
+
+
+class ChatStateStore(abc.ABC):
+    """Interface for chat state storage.
+
+    A state is a dict (see new_chat_state). load() returns a chat's state,
+    reading it from storage if needed; get() only returns one that is
+    already in memory and never blocks. A chat has a single state dict at a
+    time, so everyone working on it sees the same changes. Code that changes
+    a state passes it to save(), and new messages go through
+    append_history() so that backends can persist them incrementally; it
+    returns the messages that fell out of the chat's history window. Ping
+    deadlines live here too, so ping_loop can ask for due chats instead of
+    walking every state.
+    """
+
+    @abc.abstractmethod
+    async def load(self, chat_id, create=False):
+        ...
+
+    @abc.abstractmethod
+    def get(self, chat_id):
+        ...
+
+    @abc.abstractmethod
+    def save(self, chat_id, state):
+        ...
+
+    @abc.abstractmethod
+    def append_history(self, chat_id, state, message):
+        ...
+
+    @abc.abstractmethod
+    def schedule_ping(self, chat_id, when) -> bool:
+        """Set the chat's ping deadline. Returns True if it is now the earliest."""
+
+    @abc.abstractmethod
+    def cancel_ping(self, chat_id):
+        ...
+
+    @abc.abstractmethod
+    async def pop_due_pings(self, now, limit):
+        """Claim up to limit chats whose ping deadline has passed."""
+
+    @abc.abstractmethod
+    def next_ping_at(self):
+        ...
+
+    @abc.abstractmethod
+    def __len__(self):
+        ...
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class MemoryStateStore(ChatStateStore):
+    def __init__(self, history_budget):
+        self.history_budget = history_budget
+        self.states = {}
+        self.pings = PingSchedule()
+
+    async def load(self, chat_id, create=False):
+        state = self.states.get(chat_id)
+        if state is None and create:
+            state = self.states[chat_id] = new_chat_state(self.history_budget)
+        return state
+
+    def get(self, chat_id):
+        return self.states.get(chat_id)
+
+    def save(self, chat_id, state):
+        pass
+
+    def append_history(self, chat_id, state, message):
+        return state["history"].append(message)
+
+    def schedule_ping(self, chat_id, when) -> bool:
+        return self.pings.schedule(chat_id, when)
+
+    def cancel_ping(self, chat_id):
+        self.pings.cancel(chat_id)
+
+    async def pop_due_pings(self, now, limit):
+        return [chat_id for chat_id, _ in self.pings.pop_due(now, limit)]
+
+    def next_ping_at(self):
+        return self.pings.next_at()
+
+    def __len__(self):
+        return len(self.states)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id INTEGER PRIMARY KEY,
+    state TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    next_ping_at REAL
+);
+CREATE INDEX IF NOT EXISTS chats_next_ping_at ON chats(next_ping_at);
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_chat_id ON history(chat_id, id);
+"""
+
+
+class SQLiteStateStore(ChatStateStore):
+    """SQLite (WAL) backend with an in-process LRU cache of hot chats.
+
+    The event loop never waits on the database. Loads run in worker
+    threads; state changes, history appends and ping deadline changes are
+    written behind in batches every flush_interval seconds. Ping deadlines
+    are served from an in-memory heap, filled from disk at start. Chats
+    idle for longer than cache_ttl, or pushed out of the cache by newer
+    ones, are dropped from memory and reloaded on the next load(), unless
+    their state is still in use somewhere, in which case the same dict is
+    handed out again.
+
+    Several uvicorn workers can share one database file. Cached states
+    older than revalidate_interval are checked against the row version on
+    load(). A write to a row that another worker has changed since it was
+    read is merged with it: fields this worker changed win, the rest keep
+    the other worker's values. Due pings are claimed with a conditional
+    UPDATE so only one process sends a given ping.
+    """
+
+    def __init__(self, path, history_budget, cache_size=10000, cache_ttl=3600,
+                 flush_interval=1.0, flush_batch=500, history_load_limit=200,
+                 revalidate_interval=5.0):
+        self.path = path
+        self.history_budget = history_budget
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.history_load_limit = history_load_limit
+        self.revalidate_interval = revalidate_interval
+
+        # with WAL, loads on the reader connection don't wait for a flush
+        self.conn = self._connect()
+        self.conn.executescript(SCHEMA)
+        self.reader = self._connect()
+        self.write_lock = threading.Lock()
+        self.read_lock = threading.Lock()
+
+        # chat_id -> [state, last_access, validated_at]
+        self.cache = OrderedDict()
+        # every state handed out, for as long as anyone holds it
+        self.live = weakref.WeakValueDictionary()
+        # states with unflushed changes, kept alive even if evicted from cache
+        self.dirty = {}
+        # states whose batch is being written right now
+        self.flushing = {}
+        self.pending_history = []
+        # chat_id -> deadline (None to clear) not yet written, and being written
+        self.pending_pings = {}
+        self.flushing_pings = {}
+        self.pings = PingSchedule()
+        self.chat_count = 0
+        self.flush_wakeup = asyncio.Event()
+        self.flush_task = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def _read(self, chat_id, known_version=None):
+        """Load a chat from disk; None if it doesn't exist or still has known_version."""
+        with self.read_lock:
+            row = self.reader.execute(
+                "SELECT state, version FROM chats WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+            if row is None or row[1] == known_version:
+                return None
+            rows = self.reader.execute(
+                "SELECT role, content FROM history WHERE chat_id = ? ORDER BY id DESC LIMIT ?",
+                (chat_id, self.history_load_limit)
+            ).fetchall()
+        state = new_chat_state(self.history_budget)
+        state.update(json.loads(row[0]))
+        state["history"] = HistoryWindow(
+            self.history_budget,
+            ({"role": role, "content": content} for role, content in reversed(rows))
+        )
+        state.version = row[1]
+        # a separate copy: the state's lists and dicts are changed in place
+        state.base = json.loads(row[0])
+        return state
+
+    def _cache_put(self, chat_id, state, validated_at=0):
+        self.cache[chat_id] = [state, time.monotonic(), validated_at]
+        self.cache.move_to_end(chat_id)
+        self.live[chat_id] = state
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _evict_idle(self):
+        cutoff = time.monotonic() - self.cache_ttl
+        while self.cache:
+            chat_id, entry = next(iter(self.cache.items()))
+            if entry[1] > cutoff:
+                break
+            del self.cache[chat_id]
+
+    def _unwritten(self, chat_id):
+        return chat_id in self.dirty or chat_id in self.flushing
+
+    def get(self, chat_id):
+        entry = self.cache.get(chat_id)
+        if entry is not None:
+            entry[1] = time.monotonic()
+            self.cache.move_to_end(chat_id)
+            return entry[0]
+        state = self.live.get(chat_id)
+        if state is not None:
+            # evicted while still in use or unwritten: keep using the same dict
+            self._cache_put(chat_id, state)
+        return state
+
+    async def load(self, chat_id, create=False):
+        state = self.get(chat_id)
+        if state is not None:
+            entry = self.cache[chat_id]
+            if time.monotonic() - entry[2] >= self.revalidate_interval and not self._unwritten(chat_id):
+                await self._revalidate(chat_id, entry)
+            return state
+
+        loaded = await asyncio.to_thread(self._read, chat_id)
+        # a concurrent load() may have got there first
+        state = self.get(chat_id)
+        if state is not None:
+            return state
+        if loaded is not None:
+            self._cache_put(chat_id, loaded, time.monotonic())
+            return loaded
+        if not create:
+            return None
+        state = new_chat_state(self.history_budget)
+        state.base = json.loads(stored_fields(state))
+        self._cache_put(chat_id, state, time.monotonic())
+        self.save(chat_id, state)
+        return state
+
+    async def _revalidate(self, chat_id, entry):
+        # another worker may have written this chat since we cached it
+        state = entry[0]
+        entry[2] = time.monotonic()
+        loaded = await asyncio.to_thread(self._read, chat_id, state.version)
+        if loaded is None or self._unwritten(chat_id):
+            return
+        # refresh in place so callers holding the dict see it too
+        state.clear()
+        state.update(loaded)
+        state.version = loaded.version
+        state.base = loaded.base
+
+    def save(self, chat_id, state):
+        self.dirty[chat_id] = state
+        if len(self.pending_history) >= self.flush_batch:
+            self.flush_wakeup.set()
+
+    def append_history(self, chat_id, state, message):
+        evicted = state["history"].append(message)
+        self.pending_history.append((chat_id, message["role"], message["content"]))
+        self.save(chat_id, state)
+        return evicted
+
+    def _write(self, states, history, pings):
+        """Write a batch; returns {chat_id: (version, fields written, created, merged)}."""
+        written = {}
+        now = time.time()
+        with self.write_lock:
+            # IMMEDIATE takes the write lock up front, so no other worker
+            # can change a row between reading its version and writing it
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for chat_id, (fields, version, base) in states.items():
+                    row = self.conn.execute(
+                        "SELECT state, version FROM chats WHERE chat_id = ?", (chat_id,)
+                    ).fetchone()
+                    merged = row is not None and row[1] != version
+                    if merged:
+                        # changed by another worker since we read it: keep
+                        # its values for the fields we haven't changed
+                        ours = json.loads(fields)
+                        fields = json.loads(row[0])
+                        fields.update({k: v for k, v in ours.items() if k not in base or base[k] != v})
+                        fields = json.dumps(fields, ensure_ascii=False)
+                    new_version = row[1] + 1 if row else 1
+                    self.conn.execute(
+                        "INSERT INTO chats (chat_id, state, version, updated_at) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT(chat_id) DO UPDATE SET state = excluded.state, "
+                        "version = excluded.version, updated_at = excluded.updated_at",
+                        (chat_id, fields, new_version, now)
+                    )
+                    written[chat_id] = (new_version, json.loads(fields), row is None, merged)
+                self.conn.executemany(
+                    "INSERT INTO history (chat_id, role, content) VALUES (?, ?, ?)", history
+                )
+                # older messages would never be loaded again
+                self.conn.executemany(
+                    "DELETE FROM history WHERE chat_id = ? AND id < "
+                    "(SELECT id FROM history WHERE chat_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                    [(chat_id, chat_id, self.history_load_limit - 1) for chat_id in {row[0] for row in history}]
+                )
+                self.conn.executemany(
+                    "UPDATE chats SET next_ping_at = ? WHERE chat_id = ?",
+                    [(when, chat_id) for chat_id, when in pings.items()]
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return written
+
+    async def flush(self):
+        if not self.dirty and not self.pending_history and not self.pending_pings:
+            return
+        flushing = self.flushing = self.dirty
+        self.dirty = {}
+        self.flushing_pings, self.pending_pings = self.pending_pings, {}
+        history, self.pending_history = self.pending_history, []
+        states = {
+            chat_id: (stored_fields(state), state.version, state.base or {})
+            for chat_id, state in flushing.items()
+        }
+        try:
+            written = await asyncio.to_thread(self._write, states, history, self.flushing_pings)
+        except Exception:
+            # put the batch back so the next flush retries it
+            for chat_id, state in flushing.items():
+                self.dirty.setdefault(chat_id, state)
+            for chat_id, when in self.flushing_pings.items():
+                self.pending_pings.setdefault(chat_id, when)
+            self.pending_history[:0] = history
+            raise
+        finally:
+            self.flushing = {}
+            self.flushing_pings = {}
+        now = time.monotonic()
+        for chat_id, (version, fields, created, merged) in written.items():
+            state = flushing[chat_id]
+            if created:
+                self.chat_count += 1
+            state.version = version
+            entry = self.cache.get(chat_id)
+            if entry is not None:
+                entry[2] = now
+            if merged:
+                self._merge_in(state, fields)
+                # forget the version so the next load() reloads the chat,
+                # the other worker's history included; a write before that
+                # just merges again
+                state.version = None
+                if entry is not None:
+                    entry[2] = 0
+            state.base = fields
+
+    @staticmethod
+    def _merge_in(state, fields):
+        """Take the other worker's values into state, except where it changed again since the flush."""
+        for key, value in fields.items():
+            old = state.base.get(key) if state.base else None
+            if value != old and json.loads(json.dumps(state.get(key), ensure_ascii=False)) == old:
+                state[key] = value
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("ошибка записи состояния")
+            self._evict_idle()
+
+    def schedule_ping(self, chat_id, when) -> bool:
+        self.pending_pings[chat_id] = when
+        return self.pings.schedule(chat_id, when)
+
+    def cancel_ping(self, chat_id):
+        # cleared on disk even if we hold no deadline: another worker may have set it
+        self.pending_pings[chat_id] = None
+        self.pings.cancel(chat_id)
+
+    def _claim(self, due):
+        claimed = []
+        with self.write_lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for chat_id, when in due:
+                    if self.conn.execute(
+                        "UPDATE chats SET next_ping_at = NULL WHERE chat_id = ? AND next_ping_at = ?",
+                        (chat_id, when)
+                    ).rowcount:
+                        claimed.append(chat_id)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return claimed
+
+    async def pop_due_pings(self, now, limit):
+        due = self.pings.pop_due(now, limit)
+        # deadlines not on disk yet: no other worker can have them
+        local = [(chat_id, when) for chat_id, when in due
+                 if chat_id in self.pending_pings or chat_id in self.flushing_pings]
+        on_disk = [item for item in due if item not in local]
+        try:
+            claimed = await asyncio.to_thread(self._claim, on_disk) if on_disk else []
+        except BaseException:
+            # put them back for the next try, unless the chat got a new
+            # deadline or a cancel meanwhile
+            for chat_id, when in due:
+                if chat_id not in self.pings.deadlines and self.pending_pings.get(chat_id, when) == when:
+                    self.pings.schedule(chat_id, when)
+            raise
+        for chat_id, when in local:
+            if self.pending_pings.get(chat_id, when) == when and chat_id not in self.pings.deadlines:
+                self.pending_pings[chat_id] = None
+                claimed.append(chat_id)
+        return claimed
+
+    def next_ping_at(self):
+        return self.pings.next_at()
+
+    def __len__(self):
+        return self.chat_count
+
+    def _read_startup(self):
+        with self.read_lock:
+            count = self.reader.execute("SELECT COUNT(*) FROM chats").fetchone()[0]
+            deadlines = self.reader.execute(
+                "SELECT chat_id, next_ping_at FROM chats WHERE next_ping_at IS NOT NULL"
+            ).fetchall()
+        return count, deadlines
+
+    async def start(self):
+        self.chat_count, deadlines = await asyncio.to_thread(self._read_startup)
+        for chat_id, when in deadlines:
+            self.pings.schedule(chat_id, when)
+        self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+        await self.flush()
+        with self.write_lock:
+            self.conn.close()
+        with self.read_lock:
+            self.reader.close()
+
+
+def create_state_store(history_budget):
+    backend = os.getenv("STATE_BACKEND", "memory")
+    if backend == "memory":
+        return MemoryStateStore(history_budget)
+    if backend == "sqlite":
+        return SQLiteStateStore(
+            os.getenv("STATE_DB_PATH", "chat_states.db"),
+            history_budget,
+            cache_size=int(os.getenv("STATE_CACHE_SIZE", "10000")),
+            cache_ttl=float(os.getenv("STATE_CACHE_TTL", "3600")),
+            flush_interval=float(os.getenv("STATE_FLUSH_INTERVAL", "1.0")),
+            flush_batch=int(os.getenv("STATE_FLUSH_BATCH", "500")),
+            history_load_limit=int(os.getenv("STATE_HISTORY_LOAD_LIMIT", "200")),
+            revalidate_interval=float(os.getenv("STATE_REVALIDATE_INTERVAL", "5")),
+        )
+    raise ValueError(f"Unknown STATE_BACKEND: {backend}")
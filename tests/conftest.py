@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+# main reads these at import time
+os.environ.setdefault("LLM_BACKEND", "fake")
+os.environ.setdefault("STATE_BACKEND", "memory")
+
+
+class Bot:
+    """main with a fresh memory store and Telegram calls recorded instead of sent."""
+
+    def __init__(self, main, monkeypatch):
+        from state_store import MemoryStateStore
+
+        self.main = main
+        self.sent = []
+        self.store = MemoryStateStore(main.HISTORY_TOKEN_BUDGET)
+        monkeypatch.setattr(main, "chat_states", self.store)
+        monkeypatch.setattr(main, "TYPING_DELAY_SCALE", 0)
+        monkeypatch.setattr(main, "send_telegram_message", self.send_message)
+        monkeypatch.setattr(main, "send_typing_action", self.send_typing_action)
+
+    async def send_message(self, chat_id, text):
+        self.sent.append((chat_id, text))
+
+    async def send_typing_action(self, chat_id):
+        pass
+
+    def history(self, chat_id):
+        return [m["content"] for m in self.store.get(chat_id)["history"]]
+
+
+@pytest.fixture
+def bot(monkeypatch):
+    import main
+
+    return Bot(main, monkeypatch)
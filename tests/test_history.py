@@ -0,0 +1,38 @@
+from history import HistoryWindow, message_tokens
+
+
+def msg(text, role="user"):
+    return {"role": role, "content": text}
+
+
+def test_keeps_messages_within_budget():
+    messages = [msg(f"сообщение {i}") for i in range(10)]
+    budget = sum(message_tokens(m) for m in messages[-3:])
+    window = HistoryWindow(budget)
+
+    evicted = []
+    for m in messages:
+        evicted += window.append(m)
+
+    assert list(window) == messages[-3:]
+    assert evicted == messages[:-3]
+    assert window.total == budget
+
+
+def test_total_follows_appends_and_evictions():
+    window = HistoryWindow(40)
+    for i in range(20):
+        window.append(msg("x" * (i * 7)))
+        assert window.total == sum(message_tokens(m) for m in window)
+        assert window.total <= 40 or len(window) == 1
+
+
+def test_newest_message_is_kept_even_over_budget():
+    window = HistoryWindow(10, [msg("привет")])
+    long = msg("очень длинное сообщение " * 20)
+
+    evicted = window.append(long)
+
+    assert evicted == [msg("привет")]
+    assert list(window) == [long]
+    assert window[-1] is long
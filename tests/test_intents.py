@@ -0,0 +1,65 @@
+import pytest
+
+from intents import IntentMatcher
+from main import INTENT_RULES, NAME_PHRASES
+
+
+@pytest.fixture
+def matcher():
+    return IntentMatcher(INTENT_RULES, NAME_PHRASES)
+
+
+def test_keyword_matches_word_prefix(matcher):
+    assert matcher.match("ну ты и дурак")["mask"] == "rude"
+    assert matcher.match("Фоточку скинь")["media"] == "📷 Фото загружено."
+
+
+def test_keyword_inside_word_does_not_match(matcher):
+    assert matcher.match("автофотография")["media"] is None
+    assert matcher.match("процедура")["mask"] is None
+
+
+def test_word_boundary_rule():
+    matcher = IntentMatcher([("mask", "rude", ["тварь"], "word")])
+    assert matcher.match("ну ты тварь!")["mask"] == "rude"
+    assert matcher.match("тварью")["mask"] is None
+
+
+def test_name_after_phrase(matcher):
+    assert matcher.match("меня зовут Олег")["name"] == "Олег"
+    assert matcher.match("Привет! Зови меня Катя.")["name"] == "Катя"
+    assert matcher.match("меня зовут")["name"] is None
+
+
+def test_earlier_rule_wins_within_intent(matcher):
+    assert matcher.match("милая дура")["mask"] == "rude"
+    assert matcher.match("вот видео и фото")["media"] == "📷 Фото загружено."
+
+
+def test_intents_are_matched_independently(matcher):
+    result = matcher.match("скинь видео, красотка, меня зовут Дима")
+    assert result == {"media": "🎥 Видео прикреплено.", "mask": "flirty", "name": "Дима"}
+    assert matcher.match("как дела?") == {"media": None, "mask": None, "name": None}
+
+
+def test_keyword_shared_by_two_intents_triggers_both():
+    matcher = IntentMatcher([
+        ("media", "🎥 Видео прикреплено.", ["видео"]),
+        ("mask", "flirty", ["видео"]),
+    ])
+    assert matcher.match("скинь видео") == {"media": "🎥 Видео прикреплено.", "mask": "flirty", "name": None}
+
+
+def test_word_hits_prefix_and_whole_word_rules():
+    matcher = IntentMatcher([
+        ("media", "📷 Фото загружено.", ["фото"]),
+        ("mask", "flirty", ["фоточка"], "word"),
+    ])
+    assert matcher.match("фоточка")["media"] == "📷 Фото загружено."
+    assert matcher.match("фоточка")["mask"] == "flirty"
+
+
+def test_hyphenated_name(matcher):
+    assert matcher.match("меня зовут Анна-Мария")["name"] == "Анна-Мария"
+    assert matcher.match("зови меня Жан-Поль, ладно?")["name"] == "Жан-Поль"
+    assert matcher.match("меня зовут Олег - и всё")["name"] == "Олег"
@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+import pytest
+
+import main
+from state_store import MemoryStateStore, PingSchedule
+
+
+def test_schedule_reports_earliest_deadline():
+    pings = PingSchedule()
+    assert pings.schedule(1, 100)
+    assert not pings.schedule(2, 200)
+    assert pings.schedule(3, 50)
+    assert pings.next_at() == 50
+
+
+def test_pop_due_in_deadline_order():
+    pings = PingSchedule()
+    for chat_id, when in [(1, 30), (2, 10), (3, 20), (4, 99)]:
+        pings.schedule(chat_id, when)
+    assert pings.pop_due(25, 10) == [(2, 10), (3, 20)]
+    assert pings.pop_due(50, 10) == [(1, 30)]
+    assert pings.next_at() == 99
+
+
+def test_rescheduled_and_cancelled_deadlines_are_skipped():
+    pings = PingSchedule()
+    pings.schedule(1, 10)
+    pings.schedule(1, 40)
+    pings.schedule(2, 20)
+    pings.cancel(2)
+    assert pings.next_at() == 40
+    assert pings.pop_due(30, 10) == []
+    assert pings.pop_due(40, 10) == [(1, 40)]
+    assert pings.next_at() is None
+
+
+def test_pop_due_respects_limit():
+    pings = PingSchedule()
+    for chat_id in range(5):
+        pings.schedule(chat_id, chat_id)
+    assert [chat_id for chat_id, _ in pings.pop_due(10, 2)] == [0, 1]
+    assert len(pings.pop_due(10, 10)) == 3
+
+
+def test_stale_entries_are_compacted():
+    pings = PingSchedule()
+    for when in range(5000):
+        pings.schedule(1, when)
+    assert len(pings.heap) <= 2 * len(pings.deadlines) + 1001
+    assert pings.pop_due(10 ** 6, 10) == [(1, 4999)]
+
+
+@pytest.fixture
+def ping_loop_state(monkeypatch):
+    monkeypatch.setattr(main, "chat_states", MemoryStateStore(main.HISTORY_TOKEN_BUDGET))
+    monkeypatch.setattr(main, "ping_tasks", {})
+    monkeypatch.setattr(main, "ping_wakeup", asyncio.Event())
+    monkeypatch.setattr(main, "ping_semaphore", asyncio.Semaphore(main.PING_CONCURRENCY))
+
+
+def test_pings_cancelled_before_they_start_release_their_permit(ping_loop_state):
+    async def run():
+        loop = asyncio.create_task(main.ping_loop())
+        for chat_id in range(main.PING_CONCURRENCY * 2):
+            main.schedule_ping(chat_id, time.time() - 1)
+            # let ping_loop dispatch it, then cancel it before it runs
+            await asyncio.sleep(0)
+            main.cancel_ping(chat_id)
+        await asyncio.sleep(0.01)
+        loop.cancel()
+        return main.ping_semaphore._value
+
+    assert asyncio.run(run()) == main.PING_CONCURRENCY
+
+
+def test_ping_loop_survives_store_errors(ping_loop_state, monkeypatch, caplog):
+    store = main.chat_states
+    pop_due_pings = store.pop_due_pings
+    sent = []
+
+    async def failing_once(now, limit):
+        monkeypatch.setattr(store, "pop_due_pings", pop_due_pings)
+        raise RuntimeError("database is locked")
+
+    async def fake_send_ping(chat_id):
+        sent.append(chat_id)
+
+    monkeypatch.setattr(store, "pop_due_pings", failing_once)
+    monkeypatch.setattr(main, "send_ping", fake_send_ping)
+    monkeypatch.setattr(main, "PING_RETRY_DELAY", 0.01)
+
+    async def run():
+        main.schedule_ping(1, time.time() - 1)
+        loop = asyncio.create_task(main.ping_loop())
+        await asyncio.sleep(0.1)
+        alive = not loop.done()
+        loop.cancel()
+        return alive
+
+    assert asyncio.run(run())
+    assert sent == [1]
+    assert main.ping_semaphore._value == main.PING_CONCURRENCY
+    assert "ошибка планировщика пингов" in caplog.text
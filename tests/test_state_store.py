@@ -0,0 +1,193 @@
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+from state_store import SQLiteStateStore
+
+
+def user(text):
+    return {"role": "user", "content": text}
+
+
+def open_store(path, **kwargs):
+    return SQLiteStateStore(str(path), 10000, **kwargs)
+
+
+def test_flush_and_reload(tmp_path):
+    db = tmp_path / "states.db"
+
+    async def write():
+        store = open_store(db)
+        await store.start()
+        state = await store.load(1, create=True)
+        store.append_history(1, state, user("меня зовут Олег"))
+        state["name"] = "Олег"
+        store.save(1, state)
+        await store.flush()
+        store.append_history(1, state, {"role": "assistant", "content": "привет, олег"})
+        store.schedule_ping(1, 1000.0)
+        await store.close()
+
+    async def read():
+        store = open_store(db)
+        await store.start()
+        try:
+            return await store.load(1), await store.load(2), len(store), store.next_ping_at()
+        finally:
+            await store.close()
+
+    asyncio.run(write())
+    state, missing, count, next_ping_at = asyncio.run(read())
+
+    assert state["name"] == "Олег"
+    assert [m["content"] for m in state["history"]] == ["меня зовут Олег", "привет, олег"]
+    assert missing is None
+    assert count == 1
+    assert next_ping_at == 1000.0
+
+
+def test_state_in_use_survives_cache_eviction(tmp_path):
+    db = tmp_path / "states.db"
+
+    async def turn():
+        store = open_store(db, cache_size=2)
+        await store.start()
+        state = await store.load(1, create=True)
+        await store.flush()
+        # other chats push chat 1 out of the cache mid-turn, before and after
+        # its changes are saved
+        for chat_id in (2, 3, 4):
+            await store.load(chat_id, create=True)
+        assert await store.load(1) is state
+        store.append_history(1, state, user("меня зовут Олег"))
+        state["name"] = "Олег"
+        state["mask"] = "rude"
+        store.save(1, state)
+        for chat_id in (5, 6):
+            await store.load(chat_id, create=True)
+        store.append_history(1, state, {"role": "assistant", "content": "ну привет"})
+        assert store.get(1) is state
+        await store.close()
+
+        store = open_store(db)
+        await store.start()
+        reloaded = await store.load(1)
+        await store.close()
+        return reloaded
+
+    state = asyncio.run(turn())
+
+    assert state["name"] == "Олег"
+    assert state["mask"] == "rude"
+    assert [m["content"] for m in state["history"]] == ["меня зовут Олег", "ну привет"]
+
+
+def test_history_table_is_pruned(tmp_path):
+    db = tmp_path / "states.db"
+
+    async def run():
+        store = open_store(db, history_load_limit=3)
+        await store.start()
+        state = await store.load(1, create=True)
+        for i in range(10):
+            store.append_history(1, state, user(f"m{i}"))
+            await store.flush()
+        rows = store.conn.execute("SELECT content FROM history ORDER BY id").fetchall()
+        await store.close()
+        return [content for content, in rows]
+
+    assert asyncio.run(run()) == ["m7", "m8", "m9"]
+
+
+def test_due_ping_is_claimed_once_across_workers(tmp_path):
+    db = tmp_path / "states.db"
+
+    async def run():
+        first = open_store(db)
+        await first.start()
+        for chat_id in (1, 2):
+            await first.load(chat_id, create=True)
+            first.schedule_ping(chat_id, time.time() - 1)
+        await first.flush()
+
+        second = open_store(db)
+        await second.start()
+        # a message for chat 1 reached the second worker
+        second.cancel_ping(1)
+        await second.flush()
+
+        claimed = await first.pop_due_pings(time.time(), 10), await second.pop_due_pings(time.time(), 10)
+        await first.close()
+        await second.close()
+        return claimed
+
+    assert asyncio.run(run()) == ([2], [])
+
+
+def test_concurrent_writes_from_two_workers_are_merged(tmp_path):
+    db = tmp_path / "states.db"
+
+    async def run():
+        first = open_store(db)
+        second = open_store(db)
+        await first.start()
+        await second.start()
+        state = await first.load(1, create=True)
+        first.append_history(1, state, user("привет"))
+        await first.flush()
+
+        # both workers hold the chat; the second learns the name first
+        other = await second.load(1)
+        second.append_history(1, other, user("меня зовут Олег"))
+        other["name"] = "Олег"
+        second.save(1, other)
+        await second.flush()
+
+        state["ping_sent_at"] = 123
+        first.save(1, state)
+        await first.flush()
+        in_memory = dict(state)
+        reloaded = await first.load(1)
+        await first.close()
+        await second.close()
+
+        third = open_store(db)
+        await third.start()
+        on_disk = await third.load(1)
+        await third.close()
+        return in_memory, reloaded, on_disk
+
+    in_memory, reloaded, on_disk = asyncio.run(run())
+
+    assert on_disk["name"] == "Олег"
+    assert on_disk["ping_sent_at"] == 123
+    assert in_memory["name"] == "Олег"
+    assert [m["content"] for m in reloaded["history"]] == ["привет", "меня зовут Олег"]
+
+
+def test_failed_ping_claim_keeps_the_deadlines(tmp_path, monkeypatch):
+    db = tmp_path / "states.db"
+
+    async def run():
+        store = open_store(db)
+        await store.start()
+        await store.load(1, create=True)
+        store.schedule_ping(1, time.time() - 1)
+        await store.flush()
+
+        claim = store._claim
+
+        def locked(due):
+            monkeypatch.setattr(store, "_claim", claim)
+            raise sqlite3.OperationalError("database is locked")
+
+        monkeypatch.setattr(store, "_claim", locked)
+        with pytest.raises(sqlite3.OperationalError):
+            await store.pop_due_pings(time.time(), 10)
+        retried = await store.pop_due_pings(time.time(), 10)
+        await store.close()
+        return retried
+
+    assert asyncio.run(run()) == [1]
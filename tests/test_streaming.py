@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+def test_split_ready_chunks_cuts_long_sentences():
+    text = "Это довольно длинное первое предложение ответа. А это второе, и оно ещё не законч"
+    chunks, rest = main.split_ready_chunks(text)
+    assert chunks == ["Это довольно длинное первое предложение ответа."]
+    assert rest == "А это второе, и оно ещё не законч"
+
+
+def test_split_ready_chunks_merges_short_sentences():
+    chunks, rest = main.split_ready_chunks("Да. Нет. Может быть")
+    assert chunks == []
+    assert rest == "Да. Нет. Может быть"
+
+
+def test_split_ready_chunks_always_splits_lines():
+    chunks, rest = main.split_ready_chunks("ок\n\nну и ладно\nещё")
+    assert chunks == ["ок", "ну и ладно"]
+    assert rest == "ещё"
+
+
+def test_insert_name_ignores_stray_braces(bot):
+    state = asyncio.run(bot.store.load(1, create=True))
+    state["inflections"] = {"nomn": "Олег", "accs": "Олега", "ablt": "Олегом"}
+    assert main.insert_name(1, "привет, {name}") == "привет, Олег"
+    assert main.insert_name(1, "смайлик :-{ и {") == "смайлик :-{ и {"
+
+
+@pytest.fixture
+def streaming(bot, monkeypatch):
+    monkeypatch.setattr(main, "STREAM_REPLIES", True)
+    monkeypatch.setattr(main, "STREAM_MIN_CHUNK_CHARS", 1)
+    return bot
+
+
+def fake_stream(*pieces, error=None):
+    async def stream_completion(messages, model="gpt-4"):
+        for piece in pieces:
+            yield piece
+        if error:
+            raise error
+
+    return stream_completion
+
+
+def test_streamed_reply_is_remembered(streaming, monkeypatch):
+    monkeypatch.setattr(main, "stream_completion", fake_stream("Привет. ", "Как ", "дела?"))
+
+    asyncio.run(main.handle_update(1, "привет"))
+
+    assert [text for _, text in streaming.sent] == ["Привет.\n\nМаска: friendly", "Как дела?\n\nМаска: friendly"]
+    assert streaming.history(1) == ["привет", "Привет.\nКак дела?"]
+    assert streaming.store.next_ping_at() is not None
+
+
+def test_chunks_sent_before_a_stream_error_are_remembered(streaming, monkeypatch):
+    error = RuntimeError("stream broke")
+    monkeypatch.setattr(main, "stream_completion", fake_stream("Привет. ", "Как дела? ", "А у", error=error))
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(main.handle_update(1, "привет"))
+
+    state = streaming.store.get(1)
+    assert len(streaming.sent) == 2
+    assert streaming.history(1) == ["привет", "Привет.\nКак дела?"]
+    assert state["last_bot_reply"] > 0
+    assert streaming.store.next_ping_at() == state["last_bot_reply"] + main.PING_MIN_DELAY
+
+
+def test_nothing_is_remembered_when_nothing_was_sent(streaming, monkeypatch):
+    monkeypatch.setattr(main, "stream_completion", fake_stream(error=RuntimeError("no answer")))
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(main.handle_update(1, "привет"))
+
+    assert streaming.sent == []
+    assert streaming.history(1) == ["привет"]
+    assert streaming.store.get(1)["last_bot_reply"] == 0
+    assert streaming.store.next_ping_at() is None
@@ -0,0 +1,70 @@
+import asyncio
+
+import main
+from history import message_tokens
+from state_store import MemoryStateStore
+
+
+def msg(i):
+    return {"role": "user", "content": f"m{i}"}
+
+
+def enable_summaries(monkeypatch, window_messages, min_pending_messages, max_pending_messages):
+    # every message costs the same, so budgets can be counted in messages
+    tokens = message_tokens(msg(0))
+    store = MemoryStateStore(window_messages * tokens)
+    monkeypatch.setattr(main, "chat_states", store)
+    monkeypatch.setattr(main, "SUMMARY_ENABLED", True)
+    monkeypatch.setattr(main, "SUMMARY_MIN_PENDING_TOKENS", min_pending_messages * tokens)
+    monkeypatch.setattr(main, "SUMMARY_MAX_PENDING_TOKENS", max_pending_messages * tokens)
+    return store
+
+
+def test_evicted_messages_are_folded_into_summary(monkeypatch):
+    store = enable_summaries(monkeypatch, window_messages=3, min_pending_messages=2, max_pending_messages=100)
+
+    async def run():
+        state = await store.load(1, create=True)
+        for i in range(10):
+            main.remember(1, state, msg(i))
+            await asyncio.gather(*main.summary_tasks.values())
+        return state
+
+    state = asyncio.run(run())
+
+    assert [m["content"] for m in state["history"]] == ["m7", "m8", "m9"]
+    # the fake backend answers with the start of the prompt it got
+    assert state["summary"].startswith("ну да. Прежняя сводка")
+    assert [m["content"] for m in state["summary_pending"]] == ["m6"]
+    assert main.build_memory_message(state)["content"].endswith(state["summary"])
+
+
+def test_messages_evicted_while_summarising_are_kept(monkeypatch):
+    store = enable_summaries(monkeypatch, window_messages=1, min_pending_messages=1, max_pending_messages=2)
+    release = asyncio.Event()
+    summarised = []
+
+    async def slow_summarize(previous, messages, model, max_tokens):
+        summarised.extend(m["content"] for m in messages)
+        await release.wait()
+        return "сводка"
+
+    monkeypatch.setattr(main, "summarize", slow_summarize)
+
+    async def run():
+        state = await store.load(1, create=True)
+        main.remember(1, state, msg(0))
+        main.remember(1, state, msg(1))  # evicts m0 and starts summarising it
+        await asyncio.sleep(0)
+        # two more evictions overflow the pending list, which drops m0
+        main.remember(1, state, msg(2))
+        main.remember(1, state, msg(3))
+        release.set()
+        await asyncio.gather(*main.summary_tasks.values())
+        return state
+
+    state = asyncio.run(run())
+
+    assert summarised == ["m0"]
+    assert state["summary"] == "сводка"
+    assert [m["content"] for m in state["summary_pending"]] == ["m1", "m2"]
@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import main
+
+
+class FakeTelegram:
+    """Answers Bot API calls from a list of responses or exceptions."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def __call__(self, request):
+        self.calls.append(request.url.path.rsplit("/", 1)[-1])
+        outcome = self.outcomes.pop(0) if len(self.outcomes) > 1 else self.outcomes[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return httpx.Response(outcome[0], json=outcome[1])
+
+
+OK = (200, {"ok": True, "result": {}})
+
+
+@pytest.fixture
+def backoffs(monkeypatch):
+    delays = []
+    sleep = asyncio.sleep
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(main.asyncio, "sleep", fake_sleep)
+    monkeypatch.setattr(main, "global_send_bucket", main.TokenBucket(1000, 1000))
+    return delays
+
+
+def call(fake, method="sendMessage"):
+    async def run():
+        main.telegram_client = httpx.AsyncClient(transport=httpx.MockTransport(fake))
+        try:
+            return await main.telegram_call(method, {"chat_id": 1})
+        finally:
+            await main.telegram_client.aclose()
+            main.telegram_client = None
+
+    return asyncio.run(run())
+
+
+def test_success(backoffs):
+    fake = FakeTelegram(OK)
+    assert call(fake) == {"ok": True, "result": {}}
+    assert fake.calls == ["sendMessage"]
+
+
+@pytest.mark.parametrize("error", [httpx.ConnectError("refused"), httpx.ConnectTimeout("slow")])
+def test_retries_errors_before_the_request_is_sent(backoffs, error):
+    fake = FakeTelegram(error, error, OK)
+    assert call(fake) is not None
+    assert len(fake.calls) == 3
+    assert backoffs == [1.0, 2.0]
+
+
+@pytest.mark.parametrize("outcome", [httpx.ReadTimeout("slow"), httpx.RemoteProtocolError("closed"), (502, {})])
+def test_does_not_resend_a_message_that_may_have_arrived(backoffs, outcome):
+    fake = FakeTelegram(outcome, OK)
+    assert call(fake) is None
+    assert fake.calls == ["sendMessage"]
+
+
+@pytest.mark.parametrize("outcome", [httpx.ReadTimeout("slow"), (502, {})])
+def test_retries_idempotent_methods(backoffs, outcome):
+    fake = FakeTelegram(outcome, OK)
+    assert call(fake, "sendChatAction") is not None
+    assert fake.calls == ["sendChatAction", "sendChatAction"]
+
+
+def test_429_waits_retry_after_or_backs_off(backoffs):
+    fake = FakeTelegram((429, {"parameters": {"retry_after": 7}}), (429, {}), (429, {}), OK)
+    assert call(fake) is not None
+    assert backoffs == [7, 2.0, 4.0]
+
+
+def test_gives_up_after_max_retries(backoffs):
+    fake = FakeTelegram(httpx.ConnectError("refused"))
+    assert call(fake) is None
+    assert len(fake.calls) == main.TELEGRAM_MAX_RETRIES + 1
+
+
+def test_client_closed():
+    assert asyncio.run(main.telegram_request("sendMessage", {"chat_id": 1})) is None
+
+
+def test_token_bucket_spreads_out_a_burst():
+    async def run():
+        bucket = main.TokenBucket(rate=50, capacity=2)
+        start = time.monotonic()
+        times = []
+        for _ in range(5):
+            await bucket.acquire()
+            times.append(time.monotonic() - start)
+        return times
+
+    times = asyncio.run(run())
+    # the first two fit the capacity, the rest come 1/rate apart
+    assert times[1] < 0.01
+    assert times[4] == pytest.approx(3 / 50, abs=0.02)
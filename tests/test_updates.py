@@ -0,0 +1,123 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+import pytest
+
+import llm
+import main
+
+
+@pytest.fixture
+def lanes(bot, monkeypatch):
+    monkeypatch.setattr(main, "chat_lanes", {})
+    monkeypatch.setattr(main, "pending_updates", 0)
+    monkeypatch.setattr(main, "seen_updates", OrderedDict())
+    monkeypatch.setattr(main, "DEBOUNCE_SECONDS", 0)
+    return bot
+
+
+def update(update_id, text, chat_id=1):
+    return {"update_id": update_id, "message": {"chat": {"id": chat_id}, "text": text}}
+
+
+async def wait_idle(timeout=2):
+    deadline = time.monotonic() + timeout
+    while main.chat_lanes and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    assert not main.chat_lanes
+
+
+def test_duplicate_updates_are_dropped(monkeypatch):
+    monkeypatch.setattr(main, "seen_updates", OrderedDict())
+    monkeypatch.setattr(main, "SEEN_UPDATES_SIZE", 3)
+
+    assert not main.is_duplicate_update(1)
+    assert main.is_duplicate_update(1)
+    assert not main.is_duplicate_update(None)
+    assert not main.is_duplicate_update(None)
+    for update_id in (2, 3, 4):
+        assert not main.is_duplicate_update(update_id)
+    # only the most recent SEEN_UPDATES_SIZE ids are kept
+    assert not main.is_duplicate_update(1)
+
+
+def test_redelivered_update_is_answered_once(lanes):
+    async def run():
+        main.accept_update(update(1, "привет"))
+        main.accept_update(update(1, "привет"))
+        await wait_idle()
+
+    asyncio.run(run())
+    assert lanes.history(1) == ["привет", "ну да. привет"]
+    assert len(lanes.sent) == 1
+
+
+def test_burst_is_answered_as_one_turn(lanes, monkeypatch):
+    monkeypatch.setattr(main, "DEBOUNCE_SECONDS", 0.05)
+
+    async def run():
+        for i, text in enumerate(["привет", "как", "дела?"]):
+            main.accept_update(update(i, text))
+            await asyncio.sleep(0.01)
+        await wait_idle()
+
+    asyncio.run(run())
+    assert lanes.history(1) == ["привет\nкак\nдела?", "ну да. привет\nкак\nдела?"]
+    assert len(lanes.sent) == 1
+
+
+def test_message_during_load_restarts_turn_with_both(lanes, monkeypatch):
+    store = lanes.store
+    load = store.load
+    loading = asyncio.Event
+
+    async def slow_load(chat_id, create=False):
+        loading.set()
+        await asyncio.sleep(0.05)
+        return await load(chat_id, create)
+
+    monkeypatch.setattr(store, "load", slow_load)
+
+    async def run():
+        nonlocal loading
+        loading = asyncio.Event()
+        main.accept_update(update(1, "первое сообщение"))
+        await loading.wait()
+        main.accept_update(update(2, "второе"))
+        await wait_idle()
+
+    asyncio.run(run())
+    assert lanes.history(1) == ["первое сообщение\nвторое", "ну да. первое сообщение\nвторое"]
+    assert main.pending_updates == 0
+
+
+def test_message_during_generation_restarts_turn(lanes, monkeypatch):
+    monkeypatch.setattr(llm, "FAKE_LLM_LATENCY", 0.05)
+
+    async def run():
+        main.accept_update(update(1, "первое"))
+        await asyncio.sleep(0.02)
+        main.accept_update(update(2, "второе"))
+        await wait_idle()
+
+    asyncio.run(run())
+    # the first message was already saved, so only the new one is re-sent
+    assert lanes.history(1) == ["первое", "второе", "ну да. второе"]
+    assert len(lanes.sent) == 1
+
+
+def test_full_queue_asks_telegram_to_redeliver(lanes, monkeypatch):
+    monkeypatch.setattr(main, "MAX_PENDING_UPDATES", 1)
+    monkeypatch.setattr(main, "DEBOUNCE_SECONDS", 10)
+
+    async def run():
+        accepted = main.accept_update(update(1, "раз"))
+        rejected = main.accept_update(update(2, "два", chat_id=2))
+        return accepted, rejected
+
+    accepted, rejected = asyncio.run(run())
+    assert accepted == {"ok": True}
+    assert rejected.status_code == 429
+    # not marked as seen, so the re-delivery is accepted
+    assert 2 not in main.seen_updates